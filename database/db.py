@@ -1,9 +1,13 @@
 import json
 import sqlite3
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
+from itertools import islice
 from random import choice, choices
 from sqlite3 import Cursor, OperationalError
-from typing import Optional, Iterator, Union, Sequence
+from typing import Optional, Iterator, Union, Iterable
+
+# Each image takes 2 parameters, and older SQLite versions allow at most 999 parameters per statement
+ADD_IMAGES_CHUNK_SIZE = 499
 
 
 class Db:
@@ -18,6 +22,7 @@ class Db:
         self.cur = self.conn.cursor()
         self.auto_commit = auto_commit
         self.auto_close = auto_close
+        self.set_pragmas()
 
     def __enter__(self):
         return self
@@ -37,6 +42,14 @@ class Db:
         if self.conn:
             self.conn.close()
 
+    def set_pragmas(self):
+        # WAL lets the GUI, image loop and watchdog threads read while another connection is writing, and with
+        # synchronous=NORMAL commits no longer wait on an fsync
+        self.cur.execute("PRAGMA journal_mode=WAL;")
+        self.cur.execute("PRAGMA synchronous=NORMAL;")
+        self.cur.execute("PRAGMA temp_store=MEMORY;")
+        self.cur.execute("PRAGMA cache_size=-64000;")
+
     def _row_to_dict(self, row) -> dict:
         d = OrderedDict()
         if self.cur.description is None:
@@ -67,8 +80,12 @@ class Db:
         return self._row_to_dict(result)
 
     def _fetch_all(self, sql, params=None) -> Iterator[dict]:
-        for row in self._execute(sql, params).fetchall():
-            yield self._row_to_dict(row)
+        rows = self._execute(sql, params).fetchall()
+        # Read the column names once up front, instead of once per row. This also keeps the rows readable if another
+        # query runs on the cursor while they're being iterated through.
+        columns = [col[0] for col in self.cur.description]
+        for row in rows:
+            yield OrderedDict(zip(columns, row))
 
     # MIGRATIONS
 
@@ -78,6 +95,8 @@ class Db:
             self.version1()
         if version < 2:
             self.version2()
+        if version < 3:
+            self.version3()
 
     def get_version(self) -> int:
         sql = "SELECT version FROM version;"
@@ -110,6 +129,19 @@ class Db:
         """
         self._execute(sql)
 
+    def version3(self):
+        image_tables = self.get_image_tables()
+        for table_name in image_tables:
+            sql = f"""
+            CREATE INDEX IF NOT EXISTS idx_images_{table_name}_active_times_used
+            ON images_{table_name}(active, times_used) WHERE is_directory=0;
+            """
+            self._execute(sql)
+        sql = """
+        UPDATE version SET version=3;
+        """
+        self._execute(sql)
+
     # IMAGES
 
     def make_images_table(self):
@@ -127,6 +159,12 @@ class Db:
             eagle_folder_data TEXT DEFAULT NULL
         );"""
         self.cur.execute(sql)
+        # Lets the least used queries and times_used normalization find the lowest times_used without a full scan
+        sql = f"""
+        CREATE INDEX IF NOT EXISTS idx_{self.table}_active_times_used
+        ON {self.table}(active, times_used) WHERE is_directory=0;
+        """
+        self.cur.execute(sql)
 
     def get_image_tables(self):
         sql = """
@@ -162,7 +200,7 @@ class Db:
         filepath = result["filepath"]
         if increment:
             self.increment_times_used(filepath)
-        self.normalize_times_used()
+            self.normalize_times_used()
         return filepath
 
     def get_random_image_v2(self, increment: bool = True) -> str:
@@ -178,48 +216,51 @@ class Db:
         filepath = result["filepath"]
         if increment:
             self.increment_times_used(filepath)
-        self.normalize_times_used()
+            self.normalize_times_used()
         return filepath
 
     def get_random_image_with_weighting(self, increment: bool = True) -> str:
-        # Get all images and the times they've been used
+        # Get all images, with their times_used inverted so they can be used as weights. This reads every image
+        # anyway, so scan the table directly instead of going through the times_used index and looking up each row
+        # from there. The max in the subquery does use the index.
         sql = f"""
-        SELECT filepath, times_used 
-        FROM {self.table} 
+        SELECT filepath, (
+            SELECT max(times_used)
+            FROM {self.table}
+            WHERE active=1 AND is_directory=0
+        ) - times_used + 1
+        FROM {self.table} NOT INDEXED
         WHERE active=1 AND is_directory=0;
         """
         images = self.cur.execute(sql).fetchall()
-        # Break out filepaths and times_used into their own lists
-        filepaths, times_used = zip(*[(im[0], im[1]) for im in images])
-        # Invert times_used, so we can use it as weights
-        max_times_used = max(times_used)
-        weights = [max_times_used - w + 1 for w in times_used]
+        # Break out filepaths and weights into their own lists
+        filepaths, weights = zip(*images)
         # Pick a random image with the generated weights
-        filepath = choices(filepaths, weights=weights)[0]
+        filepath = choices(filepaths, weights=list(weights))[0]
         if increment:
             self.increment_times_used(filepath)
-        self.normalize_times_used()
+            self.normalize_times_used()
         return filepath
 
-    def get_random_image_from_least_used(self, increment: bool = True) -> str:
-        # Get all images and the times they've been used
-        sql = f"""
-        SELECT filepath, times_used 
-        FROM {self.table} 
-        WHERE active=1 AND is_directory=0;
+    def _least_used_images_sql(self) -> str:
+        # Gets only the least used images, which the (active, times_used) index can find without a full scan
+        return f"""
+        SELECT filepath
+        FROM {self.table}
+        WHERE active=1 AND is_directory=0 AND times_used=(
+            SELECT min(times_used)
+            FROM {self.table}
+            WHERE active=1 AND is_directory=0
+        );
         """
-        images = self.cur.execute(sql).fetchall()
-        # Sort into buckets by times used
-        weights_dict = defaultdict(list)
-        for filepath, times_used in images:
-            weights_dict[times_used].append(filepath)
-        # Get the least used images and pick a random image from that
-        least_times_used = min(weights_dict)
-        filepath = choice(weights_dict[least_times_used])
+
+    def get_random_image_from_least_used(self, increment: bool = True) -> str:
+        # Pick a random image from the least used images
+        filepath = choice([row[0] for row in self.cur.execute(self._least_used_images_sql())])
         if increment:
             # Increase the counter for how many times this image has been used and return
             self.increment_times_used(filepath)
-        self.normalize_times_used()
+            self.normalize_times_used()
         return filepath
 
     def increment_times_used(self, filepath: str) -> None:
@@ -232,6 +273,16 @@ class Db:
         """
         self.cur.execute(sql, [filepath])
 
+    def increment_times_used_many(self, filepaths: Iterable[str]) -> None:
+        # A path that's listed more than once gets incremented once per listing
+        sql = f"""
+        UPDATE {self.table}
+        SET times_used = times_used + 1,
+            total_times_used = total_times_used + 1
+        WHERE filepath=?;
+        """
+        self.cur.executemany(sql, ((f,) for f in filepaths))
+
     def normalize_times_used(self):
         sql = f"""
         WITH least_used AS (
@@ -241,7 +292,9 @@ class Db:
         )
         UPDATE {self.table} 
         SET times_used = times_used - (SELECT m FROM least_used)
-        WHERE is_directory=0 AND active=1;
+        WHERE is_directory=0 AND active=1
+          -- The least used images are usually already at 0, so don't rewrite every row for nothing
+          AND (SELECT m FROM least_used) > 0;
         """
         self.cur.execute(sql)
 
@@ -260,13 +313,23 @@ class Db:
         """
         return self._fetch_one(sql, [dir_path])
 
-    def add_images(self, filepaths: Sequence[str], ephemeral: bool = False):
+    def get_image_filepaths(self) -> set[str]:
         sql = f"""
-        INSERT INTO {self.table}(filepath, ephemeral)
-        VALUES (?, ?)
-        ON CONFLICT (filepath) DO NOTHING;
+        SELECT filepath FROM {self.table} WHERE is_directory=0;
         """
-        self.cur.executemany(sql, [(f, ephemeral) for f in filepaths])
+        return {row[0] for row in self._execute(sql)}
+
+    def add_images(self, filepaths: Iterable[str], ephemeral: bool = False):
+        # Insert the images in chunks, with one multi-row INSERT per chunk instead of one statement per image. Chunks
+        # are read from filepaths as needed, so large folder scans never have to be held in memory all at once.
+        filepaths = iter(filepaths)
+        while chunk := list(islice(filepaths, ADD_IMAGES_CHUNK_SIZE)):
+            sql = f"""
+            INSERT INTO {self.table}(filepath, ephemeral)
+            VALUES {", ".join(["(?, ?)"] * len(chunk))}
+            ON CONFLICT (filepath) DO NOTHING;
+            """
+            self.cur.execute(sql, [value for f in chunk for value in (f, ephemeral)])
 
     def add_directory(self, dir_path: str, include_subdirectories: bool = True):
         sql = f"""
@@ -309,13 +372,17 @@ class Db:
         self.cur.execute(sql)
 
     def remove_ephemeral_images_in_folder(self, dir_path: str):
+        # Match everything under the folder with a range on filepath, which can use the filepath index instead of
+        # scanning the table like LIKE did. "0" is the character after "/", so this covers every path starting with
+        # "dir_path/" and doesn't match sibling folders like "dir_path2".
+        dir_path = dir_path.rstrip("/")
         sql = f"""
         DELETE FROM {self.table} 
-        WHERE filepath LIKE ?
+        WHERE filepath >= ? AND filepath < ?
           AND is_directory=0
           AND ephemeral=1;
         """
-        self._execute(sql, [dir_path + "%"])
+        self._execute(sql, [dir_path + "/", dir_path + "0"])
 
     def set_image_to_inactive(self, filepath: str):
         sql = f"""
@@ -1,6 +1,7 @@
 import re
 import sys
 import traceback
+from array import array
 from configparser import RawConfigParser
 from math import sqrt, ceil
 from time import perf_counter_ns
@@ -9,9 +10,13 @@ import numpy as np
 from PIL import Image, ImageDraw
 from numpy.typing import NDArray
 
+# A single RGB pixel. Images are read as integer pixels, and get_common_colors_from_image() casts the subsample to
+# float32 before clustering, so the kmeans functions also receive float32 arrays.
 Pixel = NDArray[np.int_]
 gen = np.random.default_rng()
-perf_list = []
+# Titles and perf_counter_ns() timestamps from perf(), kept as parallel sequences so each sample doesn't need a tuple
+perf_titles = []
+perf_times = array("q")
 
 
 def has_transparency(img: Image):
@@ -41,6 +46,12 @@ def has_transparency(img: Image):
 def get_common_colors_from_image(img: Image.Image, config: RawConfigParser) -> list[tuple[int, int, int]]:
     try:
         perf()
+        img = downscale_image(
+            img,
+            config.getint("Kmeans", "Downscale size", fallback=700),
+            config.getint("Kmeans", "Subsample size"),
+        )
+        perf("Downscale image:")
         pixels = convert_image_to_pixels(img)
         perf("Convert image:")
         pixels = subsample(
@@ -48,6 +59,8 @@ def get_common_colors_from_image(img: Image.Image, config: RawConfigParser) -> l
             config.getint("Kmeans", "Subsample size"),
         )
         perf("Subsample:")
+        # float32 is plenty of precision for 0-255 color values, and halves the memory kmeans has to move around
+        pixels = np.ascontiguousarray(pixels, dtype=np.float32)
         # Exclude points that are too close to white (they're not interesting)
         pixels = exclude_pixels_near_white(
             pixels,
@@ -69,29 +82,53 @@ def get_common_colors_from_image(img: Image.Image, config: RawConfigParser) -> l
 
 
 def perf(title: str = ""):
-    global perf_list
+    global perf_titles, perf_times
     if not title:
         title = "Start"
-        perf_list = []
-    perf_list.append((title, perf_counter_ns()))
+        perf_titles, perf_times = [], array("q")
+    perf_titles.append(title)
+    perf_times.append(perf_counter_ns())
 
 
 def print_perf(title: str = "Total:"):
     print("Performance times:")
-    for i, perf_tuple in enumerate(perf_list):
-        if i == 0:
-            continue
-        t1, t2 = perf_list[i - 1][1], perf_list[i][1]
-        print(f"  {perf_tuple[0]} {(t2 - t1) / 1000:,} us")
-    t1, t2 = perf_list[0][1], perf_list[-1][1]
-    print(f"{title} {(t2 - t1) / 1000:,} us")
+    if len(perf_times) > 64:
+        # Let numpy diff long runs of samples in one go. perf_times is an array, so this doesn't copy it.
+        deltas = (np.diff(np.asarray(perf_times)) / 1000).tolist()
+    else:
+        deltas = [(perf_times[i] - perf_times[i - 1]) / 1000 for i in range(1, len(perf_times))]
+    for perf_title, delta in zip(perf_titles[1:], deltas):
+        print(f"  {perf_title} {delta:,} us")
+    print(f"{title} {(perf_times[-1] - perf_times[0]) / 1000:,} us")
+
+
+def downscale_image(image: Image.Image, max_size: int, min_pixels: int = 0) -> Image.Image:
+    """
+    Shrinks the image with a fast box filter so its largest side is at most `max_size`. Only a small subsample of
+    pixels gets clustered, so there's no need to convert every pixel of a large image.
+
+    The image is never shrunk below `min_pixels` pixels (the subsample size), so there are always enough pixels left
+    to subsample.
+    """
+    if not max_size or max(image.size) <= max_size:
+        return image
+    scale = max_size / max(image.size)
+    # Shrink less if the image would end up with too few pixels, e.g. a low max_size or a very wide panorama
+    scale = max(scale, sqrt(min_pixels / (image.width * image.height)))
+    if scale >= 1:
+        return image
+    new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    if new_size[0] * new_size[1] < min_pixels:
+        # Rounding down a side can drop it below min_pixels, so round both sides up instead
+        new_size = (ceil(image.width * scale), ceil(image.height * scale))
+    return image.resize(new_size, Image.Resampling.BOX)
 
 
 def convert_image_to_pixels(image: Image) -> NDArray[Pixel]:
     # First paste the image onto a white background, to flatten out any transparency
     bg = Image.new("RGB", image.size, (255, 255, 255))
     bg.paste(image, (0, 0), image if has_transparency(image) else None)
-    pixels = np.array(bg)
+    pixels = np.asarray(bg)
     # PIL Images start out as a 2D array (B&W image where each pixel is just a number)
     # or a 3D array (row, column, pixel)
     if pixels.ndim == 2:
@@ -112,21 +149,23 @@ def exclude_pixels_near_white(pixels: NDArray[Pixel], distance_threshold: float)
     if distance_threshold == 0:
         return pixels
 
-    # Define the target pixel
-    white_pixel = np.array([255, 255, 255])
-
-    # Calculate the Euclidean distance from each pixel to the white pixel
-    distances = np.linalg.norm(pixels - white_pixel, axis=1)
+    # Calculate the squared Euclidean distance from each pixel to the white pixel, skipping the sqrt per pixel
+    differences = 255 - pixels.astype(np.float32, copy=False)
+    squared_distances = np.einsum("ij,ij->i", differences, differences)
 
     # Create a boolean mask for pixels that are beyond the distance threshold
-    mask = distances >= distance_threshold
+    mask = squared_distances >= distance_threshold * distance_threshold
+
+    # Skip copying the pixels if none of them are near white
+    if mask.all():
+        return pixels
 
     # Apply the mask to filter out pixels
     return pixels[mask]
 
 
 def subsample(pixels: NDArray[Pixel], num_samples: int) -> NDArray[Pixel]:
-    random_indices = np.random.choice(pixels.shape[0], num_samples, replace=False)
+    random_indices = gen.choice(pixels.shape[0], num_samples, replace=False)
     return pixels[random_indices]
 
 
@@ -145,16 +184,12 @@ def kmeans(pixels: NDArray[Pixel], config: RawConfigParser) -> dict[tuple[int, i
         print(f"Num means: {len(means)}")
         pixel_groups_by_mean = group_pixels_by_means(means, pixels)
         # Remove any means with no associated pixel groups
-        if any(p.size == 0 for p in pixel_groups_by_mean):
-            x = len(pixel_groups_by_mean)
-            m, p = [], []
-            for i, group in enumerate(pixel_groups_by_mean):
-                if group.size > 0:
-                    m.append(means[i])
-                    p.append(group)
-            means, pixel_groups_by_mean = m, p
-            y = len(pixel_groups_by_mean)
-            print(f"Removed {x - y} empty groups", file=sys.stderr)
+        group_sizes = np.array([len(group) for group in pixel_groups_by_mean])
+        if not group_sizes.all():
+            non_empty = np.flatnonzero(group_sizes)
+            means = means[non_empty]
+            pixel_groups_by_mean = [pixel_groups_by_mean[i] for i in non_empty]
+            print(f"Removed {len(group_sizes) - len(non_empty)} empty groups", file=sys.stderr)
         old_means = means
         means = np.array([mean_of_pixels(group) for group in pixel_groups_by_mean])
         if show_mean_charts:
@@ -171,7 +206,7 @@ def kmeans(pixels: NDArray[Pixel], config: RawConfigParser) -> dict[tuple[int, i
                 break
     if show_mean_charts:
         show_mean_chart()
-    return {pixel_to_tuple(new_mean): pixel_group for new_mean, pixel_group in zip(means, pixel_groups_by_mean)}
+    return {new_mean: pixel_group for new_mean, pixel_group in zip(pixels_to_tuples(means), pixel_groups_by_mean)}
 
 
 def create_random_pixels(n: int) -> NDArray[Pixel]:
@@ -180,11 +215,16 @@ def create_random_pixels(n: int) -> NDArray[Pixel]:
 
 
 def group_pixels_by_means(means: NDArray[Pixel], pixels: NDArray[Pixel]) -> list[NDArray[Pixel]]:
-    # Calculate the squared Euclidean distance between each vector in b and each vector in a
-    distances = np.linalg.norm(pixels[:, np.newaxis] - means, axis=2)
+    # Compare squared Euclidean distances, expanded as |p - m|^2 = |p|^2 - 2p.m + |m|^2 so that no (pixels, means, 3)
+    # array of differences gets built. |p|^2 is the same for every mean, so it can't change which mean is closest.
+    distances = np.einsum("ij,ij->i", means, means) - 2 * (pixels @ means.T)
     # Find the index of the minimum distance for each vector in pixels
     closest_indices = np.argmin(distances, axis=1)
-    return [pixels[np.where(closest_indices == i)] for i in range(len(means))]
+    # Sort the pixels by their closest mean once and split them into groups, instead of scanning every pixel once
+    # per mean
+    order = np.argsort(closest_indices, kind="stable")
+    group_sizes = np.bincount(closest_indices, minlength=len(means))
+    return np.split(pixels[order], np.cumsum(group_sizes)[:-1])
 
 
 def mean_of_pixels(array_of_pixels: NDArray[Pixel]) -> Pixel:
@@ -192,11 +232,12 @@ def mean_of_pixels(array_of_pixels: NDArray[Pixel]) -> Pixel:
 
 
 def are_pixels_within_distance(pixels_a: np.ndarray, pixels_b: np.ndarray, max_distance: float) -> bool:
-    # Calculate the Euclidean distances between corresponding pixels
-    distances = np.linalg.norm(pixels_a - pixels_b, axis=1)
-    # print(f"Distances: {distances}")
+    # Calculate the squared Euclidean distances between corresponding pixels, which skips a sqrt per pixel
+    differences = pixels_a - pixels_b
+    squared_distances = np.einsum("ij,ij->i", differences, differences)
+    # print(f"Distances: {np.sqrt(squared_distances)}")
     # Check if all distances are within the max_distance
-    return np.all(distances <= max_distance)
+    return np.all(squared_distances <= max_distance * max_distance)
 
 
 def prune_means(
@@ -206,14 +247,10 @@ def prune_means(
     Finds any means that are within `pruning_distance` from each other, and removes the one with the fewest pixels
     assigned to it. Returns the pruned list of arrays, as well as the pruned pixel groups to match.
     """
-    # Manually compute pairwise Euclidean distances between rows of pixels using numpy.linalg.norm
+    # Compare the squared pairwise distances between all means in one go
     n = len(means)
-    distances = np.zeros((n, n))
-
-    for i in range(n):
-        for j in range(i + 1, n):
-            distances[i, j] = np.linalg.norm(means[i] - means[j])
-            distances[j, i] = distances[i, j]  # Symmetric matrix
+    differences = means[:, np.newaxis, :] - means[np.newaxis, :, :]
+    is_close = np.einsum("ijk,ijk->ij", differences, differences) <= pruning_distance * pruning_distance
 
     # Find groups where distance <= pruning_distance
     mean_groups = []
@@ -223,12 +260,9 @@ def prune_means(
         if i in visited:
             continue
         group = {i}
-        for j in range(n):
-            if i != j and distances[i, j] <= pruning_distance:
-                group.add(j)
+        group.update(np.flatnonzero(is_close[i]).tolist())
         visited.update(group)
-        if group:
-            mean_groups.append(group)
+        mean_groups.append(group)
 
     # If there are as many mean_groups as means, it means each group has a single mean and we can end early
     if len(means) == len(mean_groups):
@@ -245,7 +279,7 @@ def prune_means(
     arrays_to_keep = sorted(arrays_to_keep)
 
     # Delete all arrays except the ones to keep
-    final_means = np.array([means[i] for i in arrays_to_keep])
+    final_means = means[arrays_to_keep]
     final_pixel_groups = [pixel_groups[i] for i in arrays_to_keep]
     return final_means, final_pixel_groups
 
@@ -323,12 +357,8 @@ def show_mean_chart():
 
 
 def pixels_to_tuples(pixels: NDArray[Pixel]) -> list[tuple[int, int, int]]:
-    return [pixel_to_tuple(p) for p in pixels]
-
-
-def pixel_to_tuple(pixel: Pixel) -> tuple[int, int, int]:
-    rounded_array = np.round(pixel)
-    return tuple(int(x) for x in rounded_array)
+    # Round and convert the whole array at once, instead of converting one numpy scalar at a time
+    return [tuple(p) for p in np.rint(pixels).astype(int).tolist()]
 
 
 def sort_means(means: dict[tuple[int, int, int], NDArray[Pixel]]) -> list[tuple[int, int, int]]:
@@ -1,6 +1,7 @@
 import ctypes
 import json
 import os
+import queue
 import re
 import shutil
 import subprocess
@@ -8,44 +9,59 @@ import sys
 import threading
 import time
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from configparser import ConfigParser
+from functools import lru_cache, partial
 from glob import glob
 from io import BytesIO
 from json import JSONDecodeError
-from typing import Sequence, Union, Optional
+from typing import Callable, Iterator, Sequence, Union, Optional
 
-import pystray
 import win32api
 import win32clipboard
 import win32evtlog
-import win32evtlogutil
+import win32file
 import wx
 from PIL import Image, ImageFont, ImageDraw, UnidentifiedImageError
 from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
 
 import kmeans
 from database.db import Db
 
+try:
+    # orjson parses Eagle's metadata.json files several times faster than the json module
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 VERSION = "0.3.2"
 SPI_SET_DESKTOP_WALLPAPER = 0x14
+TIMESTRING_REGEX = re.compile(r"((\d+)h)?((\d+)m)?((\d+)s)?")
+COLOR_TUPLE_REGEX = re.compile(r"(\d+),\s*(\d+),\s*(\d+)")
 
 
 class PyWallpaper(wx.Frame):
+    debug = False
     config = None
     settings = None
     table_name = None
     delay = None
     error_delay = None
     font = None
+    get_text_bbox = None
     temp_image_filename = None
+    allowed_extensions = None
 
     original_file_path = None
-    file_path_history = []
+    file_path_history = None
     cycle_timer = None
-    observer, event_handlers = None, {}
-    processing_eagle = None
+    settings_timer = None
+    observer, polling_observer, event_handlers = None, None, {}
+    recursive_watch_folders = set()
     last_ephemeral_image_refresh = 0
+    event_log_queue = None
+    eagle_folder_cache = None
 
     # GUI Elements
     icon, file_list_dropdown, delay_value, delay_dropdown, add_filepath_checkbox = None, None, None, None, None
@@ -53,6 +69,10 @@ class PyWallpaper(wx.Frame):
 
     def __init__(self, debug: bool = False):
         super().__init__(None, title=f"pyWallpaper v{VERSION}")
+        self.debug = debug
+        self.event_log_queue = queue.SimpleQueue()
+        # Eagle folder path -> (metadata.json mtime, folder ids, parse_eagle_folder() result)
+        self.eagle_folder_cache = {}
         self.migrate_db()
         self.load_config()
         self.load_gui(debug)
@@ -81,6 +101,7 @@ class PyWallpaper(wx.Frame):
         self.config = c
 
         self.error_delay = int(self.parse_timestring(c.get("Settings", "Error delay")) * 1000)
+        self.file_path_history = deque(maxlen=c.getint("Settings", "History size"))
 
         font_name = c.get("Filepath", "Font name")
         try:
@@ -91,12 +112,19 @@ class PyWallpaper(wx.Frame):
         except OSError:
             print(f"Couldn't find font at '{font_name}'")
             self.font = ImageFont.load_default()
+        # Measuring text runs a full layout pass over the glyphs, so cache the measurements for repeated file paths
+        scratch_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+        self.get_text_bbox = lru_cache(maxsize=2048)(partial(scratch_draw.textbbox, (0, 0), font=self.font))
 
         self.temp_image_filename = os.path.join(
             os.environ["TEMP"],
             c.get("Advanced", "Temp image filename")
         )
 
+        # A tuple, so file names can be checked with a single str.endswith() call
+        self.allowed_extensions = tuple({"." + f.strip(" ").strip(".")
+                                         for f in c.get("Advanced", "Image types").lower().split(",")})
+
         # Load settings file
         if os.path.isfile("settings.json"):
             with open("settings.json", "r") as f:
@@ -104,7 +132,7 @@ class PyWallpaper(wx.Frame):
         else:
             self.settings = {}
 
-    def save_settings(self):
+    def save_settings(self, _event=None):
         with open("settings.json", "w") as f:
             json.dump(self.settings, f)
 
@@ -115,23 +143,20 @@ class PyWallpaper(wx.Frame):
         """
         if isinstance(timestring, (int, float)):
             return float(timestring)
-        m = re.match(r"((\d+)h)?((\d+)m)?((\d+)s)?", timestring)
+        m = TIMESTRING_REGEX.match(timestring)
         seconds = 0.0
-        try:
-            seconds += int(m.group(2)) * 3600  # hours
-        except TypeError:
-            pass
-        try:
-            seconds += int(m.group(4)) * 60  # minutes
-        except TypeError:
-            pass
-        try:
-            seconds += int(m.group(6))  # seconds
-        except TypeError:
-            pass
+        hours, minutes, secs = m.group(2), m.group(4), m.group(6)
+        if hours:
+            seconds += int(hours) * 3600
+        if minutes:
+            seconds += int(minutes) * 60
+        if secs:
+            seconds += int(secs)
         return seconds
 
     def load_gui(self, debug: bool):
+        import pystray
+
         # Create a system tray icon
         image = Image.open(self.config.get("Advanced", "Icon path"))
         menu = (
@@ -162,6 +187,10 @@ class PyWallpaper(wx.Frame):
         self.file_list_dropdown = wx.ComboBox(p, choices=image_tables, style=wx.CB_READONLY)
         self.file_list_dropdown.Bind(wx.EVT_COMBOBOX, self.select_file_list)
 
+        # Used to batch up settings changes that fire on every keystroke
+        self.settings_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.save_settings, self.settings_timer)
+
         self.delay_value = wx.SpinCtrl(p, min=1, initial=self.settings.get("delay_value", 3))
         self.delay_value.Bind(wx.EVT_SPINCTRL, self.set_delay)
         self.delay_value.Bind(wx.EVT_TEXT, self.set_delay)
@@ -238,9 +267,10 @@ class PyWallpaper(wx.Frame):
 
     # Loop functions
     def run(self):
-        self.refresh_ephemeral_images()
+        self.refresh_ephemeral_images(show_progress=True)
         self.cycle_timer = wx.Timer()
         self.cycle_timer.Bind(wx.EVT_TIMER, self.trigger_image_loop)
+        self.run_event_log_loop()
         self.trigger_image_loop(None)
         self.run_icon_loop()
         self.run_watchdog()
@@ -261,32 +291,39 @@ class PyWallpaper(wx.Frame):
 
     def pick_new_wallpaper(self):
         test_wallpaper = self.config.get("Advanced", "Load test wallpaper", fallback="").strip('"')
-        test_mode = bool(test_wallpaper)
         if test_wallpaper:
             self.set_wallpaper(test_wallpaper)
             return
         if self.original_file_path:
             self.file_path_history.append(self.original_file_path)
-            self.file_path_history = self.file_path_history[-1 * self.config.getint("Settings", "History size"):]
             print(f"History: {self.file_path_history}")
         with Db(table=self.table_name) as db:
             t1 = time.perf_counter_ns()
             algorithm = self.config.get("Settings", "Random algorithm").lower()
+            # The times_used counter is incremented and normalized below, in parallel with loading the image
             if algorithm == "pure":
-                self.original_file_path = db.get_random_image(increment=not test_mode)
+                file_path = db.get_random_image(increment=False)
             elif algorithm == "weighted":
-                self.original_file_path = db.get_random_image_with_weighting(increment=not test_mode)
+                file_path = db.get_random_image_with_weighting(increment=False)
             elif algorithm == "least used":
-                self.original_file_path = db.get_random_image_from_least_used(increment=not test_mode)
+                file_path = db.get_random_image_from_least_used(increment=False)
             else:
                 raise ValueError(f'Invalid value in "Random algorithm" config option: {algorithm}')
             t2 = time.perf_counter_ns()
             print(f"Time to get random image: {(t2 - t1) / 1000:,} us")
-        self.original_file_path = self.original_file_path.replace("/", "\\")
+        self.original_file_path = file_path.replace("/", "\\")
+        t = threading.Thread(name="increment_times_used", target=self.increment_times_used, args=(file_path,))
+        t.start()
         self.set_wallpaper(self.original_file_path)
+        t.join()
 
         self.refresh_ephemeral_images()
 
+    def increment_times_used(self, file_path: str):
+        with Db(table=self.table_name) as db:
+            db.increment_times_used(file_path)
+            db.normalize_times_used()
+
     def set_wallpaper(self, filepath):
         print(f"Loading {filepath}")
         delay = self.error_delay
@@ -323,10 +360,10 @@ class PyWallpaper(wx.Frame):
         # Add text
         if self.add_filepath_checkbox.IsChecked():
             self.add_text_to_image(img, file_path)
-        # Write to temp file
-        ext = os.path.splitext(file_path)[1]
-        temp_file_path = self.temp_image_filename + ext
-        img.save(temp_file_path)
+        # Write to temp file. The composited image is always RGB, so save it as an uncompressed BMP, which is much
+        # faster to encode than re-encoding to the source's format.
+        temp_file_path = self.temp_image_filename + ".bmp"
+        img.save(temp_file_path, "BMP")
         return temp_file_path
 
     @staticmethod
@@ -334,7 +371,7 @@ class PyWallpaper(wx.Frame):
         """
         Checks if the color string is a tuple of ints, and converts it. Otherwise, returns the string unchanged.
         """
-        m = re.search(r"(\d+),\s*(\d+),\s*(\d+)", color)
+        m = COLOR_TUPLE_REGEX.search(color)
         if m:
             return int(m.group(1)), int(m.group(2)), int(m.group(3))
         return color
@@ -345,24 +382,26 @@ class PyWallpaper(wx.Frame):
             monitor_width, monitor_height = [int(x) for x in force_monitor_size.split(", ")]
         else:
             monitor_width, monitor_height = win32api.GetSystemMetrics(0), win32api.GetSystemMetrics(1)
-        if "kmean" in bg_color or "kmean" in border_color or "kmean" in padding_color:
+        colors = (bg_color, border_color, padding_color)
+        if any("kmean" in color for color in colors):
+            # Run kmeans once, and pick every kmeans color from the same result
             common_colors = kmeans.get_common_colors_from_image(img, self.config)
-            if "kmean" in bg_color:
-                bg_color = kmeans.get_common_color(common_colors, bg_color)
-            if "kmean" in border_color:
-                border_color = kmeans.get_common_color(common_colors, border_color)
-            if "kmean" in padding_color:
-                padding_color = kmeans.get_common_color(common_colors, padding_color)
-        bg = Image.new("RGB", (monitor_width, monitor_height), bg_color)
+            bg_color, border_color, padding_color = (
+                kmeans.get_common_color(common_colors, color) if "kmean" in color else color
+                for color in colors
+            )
+        bg_size = (monitor_width, monitor_height)
         left_padding = self.settings.get("left_padding", 0)
         right_padding = self.settings.get("right_padding", 0)
         top_padding = self.settings.get("top_padding", 0)
         bottom_padding = self.settings.get("bottom_padding", 0)
-        if img:
+        if not img:
+            bg = Image.new("RGB", bg_size, bg_color)
+        else:
             # Determine aspect ratios
             image_aspect_ratio = img.width / img.height
-            bg_width = bg.width - left_padding - right_padding
-            bg_height = bg.height - top_padding - bottom_padding
+            bg_width = monitor_width - left_padding - right_padding
+            bg_height = monitor_height - top_padding - bottom_padding
             bg_aspect_ratio = bg_width / bg_height
             # Pick new image size
             if image_aspect_ratio > bg_aspect_ratio:
@@ -370,10 +409,27 @@ class PyWallpaper(wx.Frame):
             else:
                 new_img_size = (round(bg_height / img.height * img.width), bg_height)
             # Resize image to match bg
-            img = img.resize(new_img_size)
-            # Draw image border first
+            img = img.resize(new_img_size, resample=Image.Resampling.LANCZOS, reducing_gap=3.0)
             paste_x = (bg_width - img.width) // 2 + left_padding
             paste_y = (bg_height - img.height) // 2 + top_padding
+            # Check the image mode instead of scanning the alpha channel for transparent pixels
+            is_transparent = img.mode in ("RGBA", "LA") or "A" in img.getbands()
+            if is_transparent or left_padding or right_padding or top_padding or bottom_padding:
+                bg = Image.new("RGB", bg_size, bg_color)
+            else:
+                # The image will cover everything except the bars on either side of it, so skip filling the whole
+                # background and only fill in those bars
+                bg = Image.new("RGB", bg_size, None)
+                draw = ImageDraw.Draw(bg)
+                if paste_x > 0:
+                    draw.rectangle((0, 0, paste_x - 1, bg.height - 1), fill=bg_color)
+                if paste_x + img.width < bg.width:
+                    draw.rectangle((paste_x + img.width, 0, bg.width - 1, bg.height - 1), fill=bg_color)
+                if paste_y > 0:
+                    draw.rectangle((0, 0, bg.width - 1, paste_y - 1), fill=bg_color)
+                if paste_y + img.height < bg.height:
+                    draw.rectangle((0, paste_y + img.height, bg.width - 1, bg.height - 1), fill=bg_color)
+            # Draw image border first
             border_size = self.config.getint("Settings", "Border size", fallback=0)
             if border_size:
                 draw = ImageDraw.Draw(bg)
@@ -387,7 +443,7 @@ class PyWallpaper(wx.Frame):
                     fill=border_color
                 )
             # Paste image on BG
-            bg.paste(img, (paste_x, paste_y), img if kmeans.has_transparency(img) else None)
+            bg.paste(img, (paste_x, paste_y), img if is_transparent else None)
         # Add padding after image, to cover up border
         if padding_color:
             if left_padding:
@@ -402,7 +458,7 @@ class PyWallpaper(wx.Frame):
 
     def add_text_to_image(self, img: Image, text: str):
         draw = ImageDraw.Draw(img)
-        text_x, text_y, text_width, text_height = draw.textbbox((0, 0), text, font=self.font)
+        text_x, text_y, text_width, text_height = self.get_text_bbox(text)
         text_x = img.width - text_width - 10  # 10 pixels padding from the right
         text_y = img.height - text_height - 10  # 10 pixels padding from the bottom
         draw.text(
@@ -416,8 +472,9 @@ class PyWallpaper(wx.Frame):
 
     def set_desktop_wallpaper(self, path: str) -> bool:
         path = os.path.abspath(path)
-        # Windows doesn't return an error if we set the wallpaper to an invalid path, so do a check here first.
-        if not os.path.isfile(path):
+        # Windows doesn't return an error if we set the wallpaper to an invalid path. The file was just written by
+        # make_image, so only spend a stat call checking for it in debug mode.
+        if self.debug and not os.path.isfile(path):
             self.create_windows_event_log(
                 "Couldn't find the file {}".format(path),
                 event_type=win32evtlog.EVENTLOG_ERROR_TYPE,
@@ -438,14 +495,26 @@ class PyWallpaper(wx.Frame):
         # )
         return True
 
-    @staticmethod
-    def create_windows_event_log(message, event_type=win32evtlog.EVENTLOG_INFORMATION_TYPE, event_id=0):
-        win32evtlogutil.ReportEvent(
-            "Python Wallpaper Cycler",
-            event_id,
-            eventType=event_type,
-            strings=[message],
-        )
+    def create_windows_event_log(self, message, event_type=win32evtlog.EVENTLOG_INFORMATION_TYPE, event_id=0):
+        # Reporting to the event log is a synchronous RPC call, so hand it off to the event log thread
+        self.event_log_queue.put((message, event_type, event_id))
+
+    def event_log_loop(self):
+        import win32evtlogutil
+
+        while True:
+            message, event_type, event_id = self.event_log_queue.get()
+            # Report the error and keep going, so one failed write doesn't stop all later events from being logged
+            try:
+                win32evtlogutil.ReportEvent(
+                    "Python Wallpaper Cycler",
+                    event_id,
+                    eventType=event_type,
+                    strings=[message],
+                )
+            except Exception as e:
+                print(f"Failed to write to the Windows event log: {message}", file=sys.stderr)
+                print(e, file=sys.stderr)
 
     def show_previous_image(self, _event):
         if not self.file_path_history:
@@ -461,27 +530,50 @@ class PyWallpaper(wx.Frame):
     def run_icon_loop(self):
         threading.Thread(name="icon.run()", target=self.icon.run, daemon=True).start()
 
+    def run_event_log_loop(self):
+        threading.Thread(name="event_log_loop", target=self.event_log_loop, daemon=True).start()
+
     def run_watchdog(self):
+        from watchdog.observers import Observer
+        from watchdog.observers.polling import PollingObserver
+
         self.observer = Observer()
+        # The native observer drops events on network shares, so those get polled instead
+        self.polling_observer = PollingObserver(timeout=5)
         with Db(self.table_name) as db:
-            folders = db.get_active_folders()
+            # Sort parent folders first, so subfolders they already watch recursively can be skipped
+            folders = sorted(db.get_active_folders(), key=lambda f: len(f["filepath"]))
             for folder in folders:
                 eagle_folder_ids = None
                 if folder["eagle_folder_data"] is not None:
-                    eagle_folder_ids = list(json.loads(folder["eagle_folder_data"]).values())
+                    eagle_folder_ids = frozenset(json.loads(folder["eagle_folder_data"]).values())
                 self.add_observer_schedule(
                     folder["filepath"],
                     folder["include_subdirectories"],
                     eagle_folder_ids,
                 )
-        try:
-            self.observer.start()
-        except OSError as e:
-            print(e, file=sys.stderr)
+        # Start both observers only after all folders have been scheduled
+        for observer in (self.observer, self.polling_observer):
+            try:
+                observer.start()
+            except OSError as e:
+                print(e, file=sys.stderr)
+
+    @staticmethod
+    def is_network_path(dir_path: str) -> bool:
+        if dir_path.startswith(("//", "\\\\")):
+            return True
+        drive = os.path.splitdrive(dir_path)[0]
+        if not drive:
+            return False
+        return win32file.GetDriveType(drive + "\\") == win32file.DRIVE_REMOTE
 
     def add_observer_schedule(self, dir_path: str, include_subfolders: bool = False,
-                              eagle_folder_ids: Optional[list[str]] = None):
+                              eagle_folder_ids: Optional[frozenset[str]] = None):
         is_eagle = eagle_folder_ids is not None
+        if not is_eagle and self.is_in_recursive_watch_folder(dir_path):
+            print("Folder {} is already watched by a parent folder".format(dir_path))
+            return
         if dir_path not in self.event_handlers:
             event_handler = MyEventHandler(self, dir_path, is_eagle, eagle_folder_ids)
             self.event_handlers[dir_path] = event_handler
@@ -490,13 +582,24 @@ class PyWallpaper(wx.Frame):
             event_handler.eagle_folder_ids = eagle_folder_ids
         else:
             return
-        self.observer.schedule(
+        observer = self.polling_observer if self.is_network_path(dir_path) else self.observer
+        observer.schedule(
             event_handler,
             dir_path,
             recursive=include_subfolders or is_eagle
         )
+        if include_subfolders and not is_eagle:
+            self.recursive_watch_folders.add(dir_path)
         print("Scheduled watchdog for folder {}".format(dir_path))
 
+    def is_in_recursive_watch_folder(self, dir_path: str) -> bool:
+        parent = os.path.dirname(dir_path)
+        while parent != dir_path:
+            if parent in self.recursive_watch_folders:
+                return True
+            dir_path, parent = parent, os.path.dirname(parent)
+        return False
+
     # GUI Functions
     def select_file_list(self, _event):
         selected_file_list = self.file_list_dropdown.GetValue()
@@ -530,7 +633,7 @@ class PyWallpaper(wx.Frame):
         if _event:
             self.settings["delay_value"] = value
             self.settings["delay_unit"] = unit
-            self.save_settings()
+            self.settings_timer.StartOnce(500)
 
     def show_padding_test_wallpaper(self, _event):
         self.settings["left_padding"] = self.left_padding.GetValue()
@@ -598,7 +701,7 @@ class PyWallpaper(wx.Frame):
             return
         # Get all images from metadata.json, falling recursively through child folders.
         with open(os.path.join(dir_path, "metadata.json"), "rb") as f:
-            metadata = json.load(f)
+            metadata = json_loads(f.read())
         image_folders = {}
 
         def add_to_image_folder_dict(folder_list: list[dict]):
@@ -624,7 +727,7 @@ class PyWallpaper(wx.Frame):
             # Add folder data to existing folder data, and return the combined data
             folder_data = db.add_eagle_folder(dir_path, folder_data)
             db.remove_ephemeral_images_in_folder(dir_path)
-        folder_ids = list(folder_data.values())
+        folder_ids = frozenset(folder_data.values())
         file_paths = self.get_file_list_in_eagle_folder(dir_path, folder_ids)
         if file_paths:
             with Db(table=self.table_name) as db:
@@ -638,91 +741,186 @@ class PyWallpaper(wx.Frame):
                               style=wx.OK | wx.ICON_ERROR) as dialog:
             dialog.ShowModal()
 
-    def refresh_ephemeral_images(self, force_refresh=False):
+    def refresh_ephemeral_images(self, force_refresh=False, show_progress=False):
         # Check ephemeral image refresh delay first, and end early if we need to wait longer.
         delay = self.config.getint("Advanced", "Ephemeral image refresh delay", fallback=600)
         if not force_refresh and self.last_ephemeral_image_refresh + delay > time.time():
             return
         with Db(table=self.table_name) as db:
             folders = list(db.get_active_folders())
-            for folder in folders:
-                print(f"Refreshing ephemeral images for {folder['filepath']}")
-                if folder["is_eagle_directory"]:
-                    file_paths = self.get_file_list_in_eagle_folder(folder["filepath"], folder["eagle_folder_data"])
+            # Most of the scanned images are already in the DB, so only hand the new ones to add_images()
+            existing_file_paths = db.get_image_filepaths()
+        # Scan every folder before writing anything, so the slow folder scans don't hold the DB's write lock and block
+        # the other threads. All the new images then get added in one short transaction.
+        new_file_paths = []
+        for folder in folders:
+            print(f"Refreshing ephemeral images for {folder['filepath']}")
+            if folder["is_eagle_directory"]:
+                folder_ids = frozenset(json.loads(folder["eagle_folder_data"]).values())
+                if show_progress:
+                    # At startup this runs on the GUI thread, so show progress while the library is scanned
+                    file_paths = self.get_file_list_in_eagle_folder(folder["filepath"], folder_ids)
                 else:
-                    file_paths = self.get_file_list_in_folder(folder["filepath"], folder["include_subdirectories"])
-                if file_paths:
-                    db.add_images(file_paths, ephemeral=True)
+                    # The image loop calls this from its worker thread, which can't show wx dialogs
+                    folder_list = glob(os.path.join(folder["filepath"], "images/*"))
+                    file_paths = self.scan_eagle_folders(folder_list, folder_ids)
+            else:
+                file_paths = self.get_file_list_in_folder(folder["filepath"], folder["include_subdirectories"])
+            new_file_paths.extend(f for f in file_paths if f not in existing_file_paths)
+        if new_file_paths:
+            with Db(table=self.table_name) as db:
+                db.add_images(new_file_paths, ephemeral=True)
         self.last_ephemeral_image_refresh = time.time()
 
-    def get_file_list_in_folder(self, dir_path: str, include_subfolders: bool) -> Sequence[str]:
-        file_paths = []
-        allowed_extensions = ["." + f.strip(" ").strip(".")
-                              for f in self.config.get("Advanced", "Image types").lower().split(",")]
-        for dir_path, dir_names, filenames in os.walk(dir_path):
-            # If we don't want to include subfolders, clearing the `dir_names` list will stop os.walk() at the
-            # top-level directory.
-            if not include_subfolders:
-                dir_names.clear()
-            for filename in filenames:
-                ext = os.path.splitext(filename)[1].lower()
-                if ext in allowed_extensions:
-                    file_paths.append(os.path.join(dir_path, filename).replace("\\", "/"))
-        return file_paths
-
-    def get_file_list_in_eagle_folder(self, dir_path: str, folder_ids: list[str]) -> Sequence[str]:
-        self.processing_eagle = True
+    def get_file_list_in_folder(self, dir_path: str, include_subfolders: bool) -> Iterator[str]:
+        # Yield the file paths as they're found, so add_images() can insert them without building a full list first.
+        # Walk the folders with os.scandir() directly, which gets the file type of each entry without an extra stat
+        dir_paths = [dir_path.replace("\\", "/")]
+        while dir_paths:
+            dir_path = dir_paths.pop()
+            try:
+                entries = os.scandir(dir_path)
+            except OSError as e:
+                print(e, file=sys.stderr)
+                continue
+            # Build paths by appending to the folder's already-normalized prefix, instead of normalizing every path
+            prefix = dir_path.rstrip("/") + "/"
+            with entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        # Don't follow symlinked folders, same as os.walk()
+                        if include_subfolders and not entry.is_symlink():
+                            dir_paths.append(prefix + entry.name)
+                    elif entry.name.lower().endswith(self.allowed_extensions):
+                        yield prefix + entry.name
+
+    def get_file_list_in_eagle_folder(self, dir_path: str, folder_ids: frozenset[str]) -> Sequence[str]:
         progress_bar = wx.ProgressDialog("Loading Eagle library", "Scanning image folders...",
                                          style=wx.PD_APP_MODAL | wx.PD_AUTO_HIDE | wx.PD_ELAPSED_TIME | wx.PD_CAN_ABORT)
         try:
-            file_list = []
             folder_list = glob(os.path.join(dir_path, "images/*"))
             total_folders = len(folder_list)
             progress_bar.SetRange(total_folders)
             progress_bar.Update(0, f"Scanning image folders... (0/{total_folders})")
-            for i, folder_path in enumerate(folder_list):
-                file_path = self.parse_eagle_folder(folder_path, folder_ids, ignore_lock=True)
-                if file_path is not None:
-                    file_list.append(file_path)
-                pb_status = progress_bar.Update(i + 1, newmsg=f"Scanning image folders... ({i + 1}/{total_folders})")
-                # If user clicked Abort, return early
-                if not pb_status[0]:
-                    return []
-            return file_list
+            # Scan on a worker thread, so this thread is free to keep the progress dialog responsive
+            progress_queue, abort = queue.SimpleQueue(), threading.Event()
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                scan = executor.submit(self.scan_eagle_folders, folder_list, folder_ids, progress_queue.put, abort)
+                i, last_update_ns = 0, 0
+                while not scan.done() or not progress_queue.empty():
+                    try:
+                        i = progress_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                    # Redrawing the dialog for every folder costs more than parsing a folder, so only update it at
+                    # about 60 FPS. Abort clicks are still picked up at the next update.
+                    now = time.perf_counter_ns()
+                    if now - last_update_ns < 16_000_000 and i < total_folders:
+                        continue
+                    last_update_ns = now
+                    pb_status = progress_bar.Update(i, newmsg=f"Scanning image folders... ({i}/{total_folders})")
+                    # If user clicked Abort, return early
+                    if not pb_status[0]:
+                        abort.set()
+                        return []
+                return scan.result()
         finally:
             progress_bar.Close()
-            self.processing_eagle = False
 
-    def parse_eagle_folder(self, dir_path: str, folder_ids: list[str], ignore_lock: bool = False) -> Optional[str]:
-        if self.processing_eagle and not ignore_lock:
-            return None
-        file_list = glob(os.path.join(dir_path, "*.*"))
-        if os.path.join(dir_path, "metadata.json") not in file_list:
+    def scan_eagle_folders(self, folder_list: list[str], folder_ids: frozenset[str],
+                           on_progress: Optional[Callable[[int], None]] = None,
+                           abort: Optional[threading.Event] = None) -> list[str]:
+        file_list = []
+        # Each folder is a few small file reads, so parse many of them at once to keep the disk busy
+        max_workers = self.config.getint("Advanced", "Eagle scan threads", fallback=32)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [
+                executor.submit(self.parse_eagle_folder_cached, folder_path, folder_ids)
+                for folder_path in folder_list
+            ]
+            for i, future in enumerate(as_completed(futures), start=1):
+                file_path = future.result()
+                if file_path is not None:
+                    file_list.append(file_path)
+                if on_progress is not None:
+                    on_progress(i)
+                if abort is not None and abort.is_set():
+                    executor.shutdown(cancel_futures=True)
+                    return []
+        # Forget cached folders from this library's images folder that weren't found this time, e.g. images that were
+        # deleted from Eagle, so the cache doesn't keep growing while the app runs
+        scanned_folders = set(folder_list)
+        image_dirs = {os.path.dirname(folder_path) for folder_path in scanned_folders}
+        for folder_path in list(self.eagle_folder_cache):
+            if os.path.dirname(folder_path) in image_dirs and folder_path not in scanned_folders:
+                self.eagle_folder_cache.pop(folder_path, None)
+        return file_list
+
+    def parse_eagle_folder_cached(self, dir_path: str, folder_ids: frozenset[str]) -> Optional[str]:
+        # Almost none of an Eagle library changes between refreshes, so reuse the last result for a folder as long as
+        # its metadata.json hasn't been modified. That's one stat() instead of a listdir, a read and a JSON parse.
+        try:
+            mtime_ns = os.stat(os.path.join(dir_path, "metadata.json")).st_mtime_ns
+        except OSError:
+            return self.parse_eagle_folder(dir_path, folder_ids)
+        cached = self.eagle_folder_cache.get(dir_path)
+        if cached is not None and cached[0] == mtime_ns and cached[1] == folder_ids:
+            return cached[2]
+        file_path = self.parse_eagle_folder(dir_path, folder_ids)
+        self.eagle_folder_cache[dir_path] = (mtime_ns, folder_ids, file_path)
+        return file_path
+
+    def parse_eagle_folder(self, dir_path: str, folder_ids: frozenset[str]) -> Optional[str]:
+        # Find metadata.json and the image in a single pass over the folder. Like glob("*.*"), only names with a "."
+        # that aren't hidden files count.
+        has_metadata, image_name, thumbnail_name, num_files = False, None, None, 0
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if "." not in name or name.startswith("."):
+                        continue
+                    num_files += 1
+                    if name == "metadata.json":
+                        has_metadata = True
+                    elif name.endswith("_thumbnail.png"):
+                        if thumbnail_name is None:
+                            thumbnail_name = name
+                    elif image_name is None:
+                        image_name = name
+        except OSError:
+            pass
+        if not has_metadata:
             print(f"No metadata.json file found in {dir_path}", file=sys.stderr)
-            print(file_list, file=sys.stderr)
+            return None
+        prefix = dir_path.replace("\\", "/").rstrip("/") + "/"
+        with open(prefix + "metadata.json", "rb") as f:
+            data = f.read()
+        # Most images aren't in any of the chosen folders. Eagle folder ids are plain alphanumeric strings, so if none
+        # of them show up anywhere in the file, the image can be skipped without parsing the JSON.
+        if not any(folder_id.encode() in data for folder_id in folder_ids):
             return None
         try:
-            with open(os.path.join(dir_path, "metadata.json"), "rb") as f:
-                metadata = json.load(f)
+            metadata = json_loads(data)
         except JSONDecodeError as e:
-            print(f"Error when decoding {os.path.join(dir_path, 'metadata.json')}", file=sys.stderr)
+            print(f"Error when decoding {prefix}metadata.json", file=sys.stderr)
             print(e, file=sys.stderr)
             return None
         # Skip if it's not a folder_id we care about
         try:
-            if not set(folder_ids).intersection(metadata["folders"]):
+            if folder_ids.isdisjoint(metadata["folders"]):
                 return None
         except TypeError as e:
             print(folder_ids, file=sys.stderr)
             print(metadata["folders"], file=sys.stderr)
             raise
         print(f"Loading image from {dir_path}...")
-        for file_path in file_list:
-            if file_path.endswith("metadata.json"):
-                continue
-            if len(file_list) > 2 and file_path.endswith("_thumbnail.png"):
-                continue
-            return file_path.replace("\\", "/")
+        # If the folder only holds metadata.json and one image, that image is the one to use even if it's named like a
+        # thumbnail
+        if image_name is None and num_files <= 2:
+            image_name = thumbnail_name
+        if image_name is not None:
+            return prefix + image_name
         print(f"No non-thumbnail image found in {dir_path}", file=sys.stderr)
         return None
 
@@ -733,7 +931,16 @@ class PyWallpaper(wx.Frame):
         subprocess.run(["cmd", "/c", "start", "", os.path.abspath(self.original_file_path)])
 
     def copy_image_to_clipboard(self, _icon, _item):
-        img = Image.open(self.original_file_path)
+        # Encoding a large image takes a while, so do it on a worker thread instead of blocking the tray menu
+        threading.Thread(
+            name="copy_image_to_clipboard",
+            target=self.encode_image_for_clipboard,
+            args=(self.original_file_path,),
+            daemon=True,
+        ).start()
+
+    def encode_image_for_clipboard(self, file_path: str):
+        img = Image.open(file_path)
 
         # Convert the image to a format suitable for the clipboard (DIB)
         output = BytesIO()
@@ -741,6 +948,10 @@ class PyWallpaper(wx.Frame):
         data = output.getvalue()[14:]
         output.close()
 
+        wx.CallAfter(self.set_clipboard_image, data)
+
+    @staticmethod
+    def set_clipboard_image(data: bytes):
         # Open the clipboard and set the image data
         win32clipboard.OpenClipboard()
         win32clipboard.EmptyClipboard()
@@ -782,22 +993,33 @@ class PyWallpaper(wx.Frame):
         self.Show()  # Restore the main window
 
     def on_exit(self, *args):
+        if self.settings_timer.IsRunning():
+            self.settings_timer.Stop()
+            self.save_settings()
         self.icon.stop()  # Remove the system tray icon
         self.observer.stop()
+        self.polling_observer.stop()
         wx.Exit()
 
 
 class MyEventHandler(FileSystemEventHandler):
 
     def __init__(self, parent: PyWallpaper, dir_path: str, eagle_mode: bool = False,
-                 eagle_folder_ids: Optional[list[str]] = None):
+                 eagle_folder_ids: Optional[frozenset[str]] = None):
         super().__init__()
         self.parent = parent
         self.dir_path = dir_path
         self.eagle_mode = eagle_mode
         self.eagle_folder_ids = eagle_folder_ids
-        self.eagle_timer = None
+        self.eagle_images_prefix = dir_path.replace("\\", "/").rstrip("/") + "/images/"
+        self.debounce_timer = None
         self.debounce_time = 3  # seconds
+        self.pending_file_paths = set()
+        self.pending_eagle_dirs = set()
+        self.pending_lock = threading.Lock()
+        # File paths mapped to the time.monotonic() time they were last added to the DB
+        self.recently_added = {}
+        self.recently_added_time = 2  # seconds
 
     def on_created(self, event):
         if event.is_directory or event.src_path.endswith("@SynoEAStream"):
@@ -813,21 +1035,66 @@ class MyEventHandler(FileSystemEventHandler):
         self.add_file(event.src_path)
 
     def add_file(self, file_path: str):
+        # Copying a folder or syncing Eagle fires a burst of events, so collect the changed files until the events
+        # settle down and then add them all in one transaction
         file_path = file_path.replace("\\", "/")
-        if self.eagle_mode:
-            print(f"Adding '{file_path}' in Eagle mode. eagle_folder_ids={self.eagle_folder_ids}")
-            base_dir = os.path.dirname(file_path)
-            file_path = self.parent.parse_eagle_folder(base_dir, self.eagle_folder_ids)
-            if file_path is None:
-                return
-        with Db(table=self.parent.table_name) as db:
-            db.add_images([file_path], ephemeral=True)
+        with self.pending_lock:
+            if self.eagle_mode:
+                # Only the folders in the library's images folder hold images. Eagle also rewrites files in the
+                # library root on every change, and those aren't image folders.
+                dir_path = os.path.dirname(file_path)
+                if not dir_path.startswith(self.eagle_images_prefix):
+                    return
+                # Eagle writes several files per image (the image, its thumbnail and metadata.json), so only parse
+                # each changed folder once
+                print(f"Adding '{file_path}' in Eagle mode. eagle_folder_ids={self.eagle_folder_ids}")
+                self.pending_eagle_dirs.add(dir_path)
+            else:
+                # Saving a file often fires several modified events, and adding a file that's already in the DB
+                # does nothing, so skip files that were just added
+                if time.monotonic() - self.recently_added.get(file_path, 0) < self.recently_added_time:
+                    return
+                self.pending_file_paths.add(file_path)
+            if self.debounce_timer is not None:
+                self.debounce_timer.cancel()
+            self.debounce_timer = threading.Timer(self.debounce_time, self.add_pending_files)
+            self.debounce_timer.daemon = True
+            self.debounce_timer.start()
+
+    def add_pending_files(self):
+        with self.pending_lock:
+            file_paths, self.pending_file_paths = list(self.pending_file_paths), set()
+            dir_paths, self.pending_eagle_dirs = self.pending_eagle_dirs, set()
+            self.debounce_timer = None
+        for dir_path in dir_paths:
+            # Don't let one bad folder (e.g. a metadata.json that Eagle is still writing) lose the rest of the batch
+            try:
+                file_path = self.parent.parse_eagle_folder(dir_path, self.eagle_folder_ids)
+            except Exception as e:
+                print(f"Failed to parse Eagle folder {dir_path}", file=sys.stderr)
+                print(e, file=sys.stderr)
+                continue
+            if file_path is not None:
+                file_paths.append(file_path)
+        if file_paths:
+            with Db(table=self.parent.table_name) as db:
+                db.add_images(file_paths, ephemeral=True)
+        now = time.monotonic()
+        with self.pending_lock:
+            self.recently_added = {
+                file_path: added_time for file_path, added_time in self.recently_added.items()
+                if now - added_time < 60
+            }
+            self.recently_added.update((file_path, now) for file_path in file_paths)
 
     def on_deleted(self, event):
         if event.is_directory or event.src_path.endswith("@SynoEAStream"):
             return
         print(f"File deleted: {event.src_path}")
         file_path = event.src_path.replace("\\", "/")
+        with self.pending_lock:
+            self.pending_file_paths.discard(file_path)
+            self.recently_added.pop(file_path, None)
         with Db(table=self.parent.table_name) as db:
             db.delete_image(file_path)
 
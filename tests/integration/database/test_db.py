@@ -1,4 +1,3 @@
-import os
 from unittest import TestCase
 from unittest.mock import ANY, patch, Mock
 
@@ -11,18 +10,25 @@ class TestDb(TestCase):
 
     @classmethod
     def setUpClass(cls):
-        while not os.path.isdir("database"):
-            os.chdir("..")
-        with Db(cls.table) as db:
+        # Build the empty table once in memory, and give each test its own copy of it so the tests don't touch the
+        # disk or have to delete the previous test's rows
+        cls.template_db = Db(cls.table, filename=":memory:", auto_close=False)
+        with cls.template_db as db:
             db.make_images_table()
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.template_db.close()
+
     def setUp(self):
-        with Db(self.table) as db:
-            sql = "DELETE FROM images_integration_tests;"
-            db.cur.execute(sql)
+        self.db = Db(self.table, filename=":memory:", auto_close=False)
+        self.template_db.conn.backup(self.db.conn)
+
+    def tearDown(self):
+        self.db.close()
 
     def test_add_eagle_folder_new(self):
-        with Db(self.table) as db:
+        with self.db as db:
             db.add_eagle_folder(r"\\NAS\Eagle\Library", {"Art": "ABCDEFG"})
             self.assertEqual(
                 [{
@@ -31,6 +37,7 @@ class TestDb(TestCase):
                     "active": 1,
                     "is_directory": 1,
                     "times_used": 0,
+                    "total_times_used": 0,
                     "include_subdirectories": 0,
                     "ephemeral": 0,
                     "is_eagle_directory": 1,
@@ -40,7 +47,7 @@ class TestDb(TestCase):
             )
 
     def test_add_eagle_folder_add_same_id(self):
-        with Db(self.table) as db:
+        with self.db as db:
             db.add_eagle_folder(r"\\NAS\Eagle\Library", {"Art": "ABCDEFG"})
             db.add_eagle_folder(r"\\NAS\Eagle\Library", {"Art Again": "ABCDEFG"})
             self.assertEqual(
@@ -50,6 +57,7 @@ class TestDb(TestCase):
                     "active": 1,
                     "is_directory": 1,
                     "times_used": 0,
+                    "total_times_used": 0,
                     "include_subdirectories": 0,
                     "ephemeral": 0,
                     "is_eagle_directory": 1,
@@ -59,7 +67,7 @@ class TestDb(TestCase):
             )
 
     def test_add_eagle_folder_add_two_ids(self):
-        with Db(self.table) as db:
+        with self.db as db:
             db.add_eagle_folder(r"\\NAS\Eagle\Library", {"Art": "ABCDEFG"})
             db.add_eagle_folder(r"\\NAS\Eagle\Library", {"Art Again": "ZYXWV"})
             self.assertEqual(
@@ -69,6 +77,7 @@ class TestDb(TestCase):
                     "active": 1,
                     "is_directory": 1,
                     "times_used": 0,
+                    "total_times_used": 0,
                     "include_subdirectories": 0,
                     "ephemeral": 0,
                     "is_eagle_directory": 1,
@@ -78,7 +87,7 @@ class TestDb(TestCase):
             )
 
     def test_remove_ephemeral_images_in_folder(self):
-        with Db(self.table) as db:
+        with self.db as db:
             db.add_images([
                 r"//NAS/Library1/ABC.png",
                 r"//NAS/Library1/DEF.jpg",
@@ -92,6 +101,7 @@ class TestDb(TestCase):
                     "active": 1,
                     "is_directory": 0,
                     "times_used": 0,
+                    "total_times_used": 0,
                     "include_subdirectories": 0,
                     "ephemeral": 1,
                     "is_eagle_directory": 0,
@@ -100,9 +110,50 @@ class TestDb(TestCase):
                 list(db._fetch_all(f"SELECT * FROM {self.table};")),
             )
 
+    def test_remove_ephemeral_images_in_folder_skips_similar_folder_names(self):
+        with self.db as db:
+            db.add_images([
+                r"//NAS/Library1/ABC.png",
+                r"//NAS/Library1/Sub/DEF.jpg",
+                r"//NAS/Library10/ZYX.gif",
+            ], ephemeral=True)
+            db.remove_ephemeral_images_in_folder(r"//NAS/Library1/")
+            self.assertEqual(
+                [r"//NAS/Library10/ZYX.gif"],
+                [row[0] for row in db.cur.execute(f"SELECT filepath FROM {self.table};")],
+            )
+
+    def test_add_images_in_chunks(self):
+        with self.db as db:
+            filepaths = [f"//NAS/Library1/{i}.png" for i in range(1200)]
+            db.add_images([filepaths[0]])
+            # Includes an image that's already in the table and a duplicate within the same chunk
+            db.add_images(iter(filepaths + [filepaths[-1]]), ephemeral=True)
+            self.assertEqual(
+                [(f, 1 if i else 0) for i, f in enumerate(filepaths)],
+                db.cur.execute(f"SELECT filepath, ephemeral FROM {self.table} ORDER BY id;").fetchall(),
+            )
+
+    def test_get_image_filepaths(self):
+        with self.db as db:
+            db.add_directory(r"//NAS/Library1")
+            db.add_images([
+                r"//NAS/Library1/ABC.png",
+                r"//NAS/Library1/DEF.jpg",
+            ], ephemeral=True)
+            db.add_images([r"//NAS/Library2/ZYX.gif"])
+            self.assertEqual(
+                {
+                    r"//NAS/Library1/ABC.png",
+                    r"//NAS/Library1/DEF.jpg",
+                    r"//NAS/Library2/ZYX.gif",
+                },
+                db.get_image_filepaths(),
+            )
+
     @patch("database.db.choices", return_value=[r"//NAS/Library1/ABC.png"])
     def test_get_random_image_with_weighting(self, choices_mock: Mock):
-        with Db(self.table) as db:
+        with self.db as db:
             filepaths = [
                 r"//NAS/Library1/ABC.png",
                 r"//NAS/Library1/DEF.jpg",
@@ -110,14 +161,9 @@ class TestDb(TestCase):
                 r"//NAS/Library2/WVU.gif",
             ]
             db.add_images(filepaths, ephemeral=True)
-            db.increment_times_used(filepaths[0])
-            db.increment_times_used(filepaths[1])
-            db.increment_times_used(filepaths[1])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[3])
+            db.increment_times_used_many(
+                [filepaths[0]] + [filepaths[1]] * 2 + [filepaths[2]] * 4 + [filepaths[3]]
+            )
             self.assertEqual(filepaths[0], db.get_random_image_with_weighting())
             choices_mock.assert_called_once_with(tuple(filepaths), weights=[4, 3, 1, 4])
             # Check for times_used normalization
@@ -134,7 +180,7 @@ class TestDb(TestCase):
 
     @patch("database.db.choice", return_value=r"//NAS/Library1/ABC.png")
     def test_get_random_image_from_least_used(self, choice_mock: Mock):
-        with Db(self.table) as db:
+        with self.db as db:
             filepaths = [
                 r"//NAS/Library1/ABC.png",
                 r"//NAS/Library1/DEF.jpg",
@@ -142,14 +188,9 @@ class TestDb(TestCase):
                 r"//NAS/Library2/WVU.gif",
             ]
             db.add_images(filepaths, ephemeral=True)
-            db.increment_times_used(filepaths[0])
-            db.increment_times_used(filepaths[1])
-            db.increment_times_used(filepaths[1])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[3])
+            db.increment_times_used_many(
+                [filepaths[0]] + [filepaths[1]] * 2 + [filepaths[2]] * 4 + [filepaths[3]]
+            )
             self.assertEqual(filepaths[0], db.get_random_image_from_least_used())
             choice_mock.assert_called_once_with(['//NAS/Library1/ABC.png', '//NAS/Library2/WVU.gif'])
             # Check for times_used normalization
@@ -164,8 +205,19 @@ class TestDb(TestCase):
                 db.cur.execute(sql).fetchall(),
             )
 
+    def test_least_used_query_uses_index(self):
+        with self.db as db:
+            sql = "EXPLAIN QUERY PLAN " + db._least_used_images_sql()
+            # Both the outer query and the subquery should search the index instead of scanning the table. Older
+            # SQLite versions word the plan differently ("SEARCH TABLE ..."), so only check for the index name.
+            plan = [row[3] for row in db.cur.execute(sql).fetchall() if row[3].startswith(("SCAN", "SEARCH"))]
+            self.assertEqual(2, len(plan))
+            for detail in plan:
+                self.assertFalse(detail.startswith("SCAN"), detail)
+                self.assertIn(f"idx_{self.table}_active_times_used", detail)
+
     def test_normalize_times_used(self):
-        with Db(self.table) as db:
+        with self.db as db:
             filepaths = [
                 r"//NAS/Library1/ABC.png",
                 r"//NAS/Library1/DEF.jpg",
@@ -173,17 +225,9 @@ class TestDb(TestCase):
                 r"//NAS/Library2/WVU.gif",
             ]
             db.add_images(filepaths, ephemeral=True)
-            db.increment_times_used(filepaths[0])
-            db.increment_times_used(filepaths[0])
-            db.increment_times_used(filepaths[0])
-            db.increment_times_used(filepaths[1])
-            db.increment_times_used(filepaths[1])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[2])
-            db.increment_times_used(filepaths[3])
-            db.increment_times_used(filepaths[3])
+            db.increment_times_used_many(
+                [filepaths[0]] * 3 + [filepaths[1]] * 2 + [filepaths[2]] * 4 + [filepaths[3]] * 2
+            )
             db.normalize_times_used()
             sql = "SELECT filepath, times_used FROM images_integration_tests;"
             self.assertEqual(
@@ -1,12 +1,47 @@
 from unittest import TestCase
 
 import numpy as np
+from PIL import Image
 
-from kmeans import exclude_pixels_near_white, pixels_to_tuples, prune_means
+from kmeans import downscale_image, exclude_pixels_near_white, group_pixels_by_means, pixels_to_tuples, prune_means
+
+
+def read_only(array: np.ndarray) -> np.ndarray:
+    array.flags.writeable = False
+    return array
+
+
+# Shared by the pruning tests. They're read-only, so a test that modifies them fails instead of affecting the others.
+PRUNING_MEANS = read_only(np.array([[1, 2, 3], [4, 5, 6], [1.5, 2.5, 3.5], [10, 10, 10]]))
+PRUNING_PIXEL_GROUPS = (
+    read_only(np.array([[7, 8, 9], [10, 11, 12]])),
+    read_only(np.array([[13, 14, 15]])),
+    read_only(np.array([[1, 1, 1], [2, 2, 2], [3, 3, 3]])),
+    read_only(np.array([[14, 14, 14]])),
+)
 
 
 class TestKmeans(TestCase):
 
+    def test_downscale_image(self):
+        image = downscale_image(Image.new("RGB", (1920, 1080)), 700, 1000)
+        self.assertEqual((700, 394), image.size)
+
+    def test_downscale_image_already_small(self):
+        image = Image.new("RGB", (640, 480))
+        self.assertIs(image, downscale_image(image, 700, 1000))
+
+    def test_downscale_image_keeps_subsample_size(self):
+        image = downscale_image(Image.new("RGB", (1920, 1080)), 30, 1000)
+        self.assertGreaterEqual(image.width * image.height, 1000)
+        self.assertLess(image.width, 1920)
+
+    def test_downscale_image_panorama(self):
+        # Shrinking to 700x1 would leave fewer pixels than the subsample size, so the image isn't shrunk as far
+        image = downscale_image(Image.new("RGB", (5000, 7)), 700, 1000)
+        self.assertGreaterEqual(image.width * image.height, 1000)
+        self.assertLess(image.width, 5000)
+
     def test_white_exclusion(self):
         pixels = [[1, 104, 221], [84, 120, 39], [209, 92, 192]]
         pixels = np.array(pixels)
@@ -27,15 +62,14 @@ class TestKmeans(TestCase):
             set(pixels).difference(new_pixels),
         )
 
+    def test_white_exclusion_matches_euclidean_distance(self):
+        pixels = np.random.default_rng(0).integers(0, 256, size=(10000, 3)).astype(np.float32)
+        expected = pixels[np.linalg.norm(pixels - 255, axis=1) >= 100]
+        new_pixels = exclude_pixels_near_white(pixels, 100)
+        self.assertTrue(np.array_equal(expected, new_pixels))
+
     def test_pruning_distance(self):
-        means = np.array([[1, 2, 3], [4, 5, 6], [1.5, 2.5, 3.5], [10, 10, 10]])
-        pixel_groups = [
-            np.array([[7, 8, 9], [10, 11, 12]]),
-            np.array([[13, 14, 15]]),
-            np.array([[1, 1, 1], [2, 2, 2], [3, 3, 3]]),
-            np.array([[14, 14, 14]])
-        ]
-        means, pixel_groups = prune_means(means, pixel_groups, pruning_distance=2)
+        means, pixel_groups = prune_means(PRUNING_MEANS, list(PRUNING_PIXEL_GROUPS), pruning_distance=2)
         self.assertTrue(np.array_equal(
             np.array([[4, 5, 6], [1.5, 2.5, 3.5], [10, 10, 10]]),
             means,
@@ -49,14 +83,7 @@ class TestKmeans(TestCase):
             self.assertTrue(np.array_equal(pg, npg))
 
     def test_pruning_distance_no_prune(self):
-        means = np.array([[1, 2, 3], [4, 5, 6], [1.5, 2.5, 3.5], [10, 10, 10]])
-        pixel_groups = [
-            np.array([[7, 8, 9], [10, 11, 12]]),
-            np.array([[13, 14, 15]]),
-            np.array([[1, 1, 1], [2, 2, 2], [3, 3, 3]]),
-            np.array([[14, 14, 14]])
-        ]
-        means, pixel_groups = prune_means(means, pixel_groups, pruning_distance=0.1)
+        means, pixel_groups = prune_means(PRUNING_MEANS, list(PRUNING_PIXEL_GROUPS), pruning_distance=0.1)
         self.assertTrue(np.array_equal(
             np.array([[1, 2, 3], [4, 5, 6], [1.5, 2.5, 3.5], [10, 10, 10]]),
             means,
@@ -69,3 +96,16 @@ class TestKmeans(TestCase):
         ]
         for pg, npg in zip(pixel_groups, new_pixel_groups):
             self.assertTrue(np.array_equal(pg, npg))
+
+    def test_group_pixels_by_means(self):
+        means = np.array([[0, 0, 0], [100, 100, 100], [255, 255, 255]])
+        pixels = np.array([[90, 95, 100], [10, 5, 0], [120, 110, 100], [0, 20, 10]])
+        pixel_groups = group_pixels_by_means(means, pixels)
+        new_pixel_groups = [
+            np.array([[10, 5, 0], [0, 20, 10]]),
+            np.array([[90, 95, 100], [120, 110, 100]]),
+            np.empty((0, 3)),
+        ]
+        self.assertEqual(3, len(pixel_groups))
+        for pg, npg in zip(pixel_groups, new_pixel_groups):
+            self.assertTrue(np.array_equal(pg, npg))
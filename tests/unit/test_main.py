@@ -0,0 +1,45 @@
+from unittest import TestCase, skipIf
+from unittest.mock import Mock, patch
+
+try:
+    from main import MyEventHandler
+except ImportError:
+    # main.py needs wxPython and pywin32, which are only available on Windows
+    MyEventHandler = None
+
+
+@skipIf(MyEventHandler is None, "main.py requires wxPython and pywin32")
+class TestMyEventHandler(TestCase):
+
+    library = "//NAS/Eagle/Library"
+
+    def make_handler(self) -> MyEventHandler:
+        parent = Mock()
+        parent.table_name = "images_default"
+
+        def parse_eagle_folder(dir_path: str, _folder_ids: frozenset[str]) -> str:
+            if dir_path.endswith("BAD"):
+                raise TypeError("unhashable type: 'dict'")
+            return dir_path + "/image.png"
+
+        parent.parse_eagle_folder.side_effect = parse_eagle_folder
+        return MyEventHandler(parent, self.library, eagle_mode=True, eagle_folder_ids=frozenset({"ABCDEFG"}))
+
+    @patch("main.Db")
+    def test_add_pending_files_skips_failing_eagle_folder(self, db_mock: Mock):
+        handler = self.make_handler()
+        handler.pending_eagle_dirs = {f"{self.library}/images/BAD", f"{self.library}/images/GOOD"}
+        handler.pending_file_paths = {"//NAS/Pictures/ABC.png"}
+        handler.add_pending_files()
+        db = db_mock.return_value.__enter__.return_value
+        db.add_images.assert_called_once()
+        self.assertCountEqual(
+            ["//NAS/Pictures/ABC.png", f"{self.library}/images/GOOD/image.png"],
+            db.add_images.call_args.args[0],
+        )
+
+    def test_add_file_ignores_eagle_library_root(self):
+        handler = self.make_handler()
+        handler.add_file(f"{self.library}/metadata.json")
+        self.assertEqual(set(), handler.pending_eagle_dirs)
+        self.assertIsNone(handler.debounce_timer)